@@ -28,6 +28,8 @@ CURRENCY_DISPLAY = "EUR"  # Store shows EUR
 # Embeddings
 EMBEDDING_MODEL = "google/siglip-base-patch16-384"
 EMBEDDING_DIM = 768
+# Local cache of per-image embeddings (reruns skip the model forward)
+EMBEDDING_CACHE_PATH = str(_project_dir / "embeddings_cache.sqlite3")
 
 # Requests
 REQUEST_TIMEOUT = 30
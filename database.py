@@ -4,13 +4,26 @@ Supabase products table via PostgREST REST API (no SDK).
 - Smart sync: after upsert, remove products for this source that are no longer in the catalog.
 """
 import hashlib
-import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, Optional, List, Set
 
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from config import SUPABASE_URL, SUPABASE_KEY, SOURCE, BRAND, SECOND_HAND, COUNTRY
+from config import (
+    SUPABASE_URL,
+    SUPABASE_KEY,
+    SOURCE,
+    BRAND,
+    SECOND_HAND,
+    COUNTRY,
+    MAX_RETRIES,
+    REQUEST_DELAY,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -18,12 +31,36 @@ logger = logging.getLogger(__name__)
 REST_BASE = f"{SUPABASE_URL.rstrip('/')}/rest/v1"
 PRODUCTS_ENDPOINT = f"{REST_BASE}/products"
 
-# Chunk size for upsert and for delete batches
-CHUNK_SIZE = 100
+# Upsert chunks are sized by payload bytes (embedding rows are ~12 KB each);
+# ~4 MB per POST keeps round-trip and PG parse overhead amortized.
+UPSERT_TARGET_BYTES = 4_000_000
+MIN_CHUNK_ROWS = 50
+MAX_CHUNK_ROWS = 1000
 
+# DELETE uses a URL-length-limited in.(...) filter, so it stays small
+DELETE_CHUNK_SIZE = 200
 
-def _session():
-    """HTTP session with Supabase PostgREST headers. Fails fast if key missing."""
+# Rows per Range page when fetching existing ids (id-only rows are tiny)
+ID_FETCH_PAGE = 10000
+
+# Concurrent in-flight upsert POSTs (bounded by the session's pool_maxsize)
+UPSERT_WORKERS = 8
+
+
+def _dumps(obj: Any) -> bytes:
+    """orjson encode (handles numpy arrays); ~5x stdlib json on embedding payloads."""
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+# One keep-alive session for all PostgREST calls (TLS handshake paid once)
+_SESSION: Optional[requests.Session] = None
+
+
+def _session() -> requests.Session:
+    """Shared HTTP session with Supabase PostgREST headers. Fails fast if key missing."""
+    global _SESSION
+    if _SESSION is not None:
+        return _SESSION
     if not SUPABASE_KEY:
         raise ValueError("SUPABASE_SERVICE_KEY or SUPABASE_KEY must be set in .env")
     s = requests.Session()
@@ -32,6 +69,19 @@ def _session():
         "Authorization": f"Bearer {SUPABASE_KEY}",
         "Content-Type": "application/json",
     })
+    # Upserts are idempotent (merge-duplicates), so retrying POST is safe.
+    # raise_on_status=False: once retries are exhausted the response comes back
+    # as-is, so callers keep their status_code handling (row-by-row fallback,
+    # False returns) instead of an uncaught RetryError.
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=REQUEST_DELAY,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    s.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=20, max_retries=retry))
+    _SESSION = s
     return s
 
 
@@ -41,16 +91,34 @@ def generate_id(source: str, product_url: str) -> str:
 
 def prepare_row(
     record: Dict[str, Any],
-    image_embedding: Optional[List[float]] = None,
-    info_embedding: Optional[List[float]] = None,
+    image_embedding: Optional[np.ndarray] = None,
+    info_embedding: Optional[np.ndarray] = None,
 ) -> Dict[str, Any]:
     """Build one row for public.products. All required and optional fields."""
+    row = _base_row(record)
+    # Keys always present (None when missing) so every new row shares one keyset
+    # and _normalize_rows can pass the list through untouched
+    row["image_embedding"] = image_embedding
+    row["info_embedding"] = info_embedding
+    return row
+
+
+def prepare_row_no_embeddings(record: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Row without embedding columns, for products already in DB: merge-duplicates
+    upsert refreshes mutable fields (price, sale, ...) and leaves stored
+    embeddings untouched.
+    """
+    return _base_row(record)
+
+
+def _base_row(record: Dict[str, Any]) -> Dict[str, Any]:
     product_url = record.get("product_url") or ""
-    product_id = generate_id(SOURCE, product_url)
+    product_id = record.get("id") or generate_id(SOURCE, product_url)
 
     metadata_str = None
     if record.get("metadata"):
-        metadata_str = json.dumps(record["metadata"]) if isinstance(record["metadata"], dict) else str(record["metadata"])
+        metadata_str = _dumps(record["metadata"]).decode() if isinstance(record["metadata"], dict) else str(record["metadata"])
 
     row = {
         "id": product_id,
@@ -75,11 +143,6 @@ def prepare_row(
         "additional_images": record.get("additional_images") or None,
     }
 
-    if image_embedding is not None:
-        row["image_embedding"] = image_embedding
-    if info_embedding is not None:
-        row["info_embedding"] = info_embedding
-
     return row
 
 
@@ -87,72 +150,96 @@ def _normalize_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """Ensure every row has the same set of keys (PostgREST requirement). Use None for missing."""
     if not rows:
         return []
+    # prepare_row/_base_row emit fixed keysets, so rows normally pass through as-is
+    first_keys = rows[0].keys()
+    if all(r.keys() == first_keys for r in rows[1:]):
+        return rows
     all_keys = set()
     for r in rows:
         all_keys.update(r.keys())
     return [{k: r.get(k) for k in all_keys} for r in rows]
 
 
+_PREFER_UPSERT = "resolution=merge-duplicates,return=minimal"
+
+
+def _post_chunk(session: requests.Session, chunk: List[Dict[str, Any]]) -> bool:
+    """POST one chunk; on failure retry its rows one at a time. True if all rows landed."""
+    r = session.post(
+        PRODUCTS_ENDPOINT,
+        headers={"Prefer": _PREFER_UPSERT},
+        data=_dumps(chunk),
+        timeout=60,
+    )
+    if r.status_code in (200, 201, 204):
+        return True
+    logger.warning("Batch upsert failed %s: %s", r.status_code, r.text[:500])
+    ok = True
+    for row in chunk:
+        rr = session.post(
+            PRODUCTS_ENDPOINT,
+            headers={"Prefer": _PREFER_UPSERT},
+            data=_dumps([row]),
+            timeout=60,
+        )
+        if rr.status_code not in (200, 201, 204):
+            logger.error("Upsert failed for id=%s: %s %s", row.get("id"), rr.status_code, rr.text[:300])
+            ok = False
+    return ok
+
+
 def upsert_products(rows: List[Dict[str, Any]]) -> bool:
     """
-    Upsert all products via PostgREST in chunks. On chunk failure, retry that chunk row-by-row.
-    Returns True if all succeeded, False otherwise.
+    Upsert all products via PostgREST, chunks POSTed concurrently over the pooled session.
+    On chunk failure, that chunk is retried row-by-row. Returns True if all succeeded.
     """
     if not rows:
         return True
     normalized = _normalize_rows(rows)
     session = _session()
-    prefer = "resolution=merge-duplicates,return=minimal"
-
-    for i in range(0, len(normalized), CHUNK_SIZE):
-        chunk = normalized[i : i + CHUNK_SIZE]
-        r = session.post(
-            PRODUCTS_ENDPOINT,
-            headers={"Prefer": prefer},
-            data=json.dumps(chunk),
-            timeout=60,
-        )
-        if r.status_code in (200, 201, 204):
-            continue
-        logger.warning("Batch upsert failed %s: %s", r.status_code, r.text[:500])
-        # Retry chunk one row at a time
-        for row in chunk:
-            rr = session.post(
-                PRODUCTS_ENDPOINT,
-                headers={"Prefer": prefer},
-                data=json.dumps([row]),
-                timeout=60,
-            )
-            if rr.status_code not in (200, 201, 204):
-                logger.error("Upsert failed for id=%s: %s %s", row.get("id"), rr.status_code, rr.text[:300])
-                return False
-    return True
+    avg_row_bytes = max(1, len(_dumps(normalized[0])))
+    rows_per_chunk = max(MIN_CHUNK_ROWS, min(MAX_CHUNK_ROWS, UPSERT_TARGET_BYTES // avg_row_bytes))
+    chunks = [
+        normalized[i : i + rows_per_chunk] for i in range(0, len(normalized), rows_per_chunk)
+    ]
+    if len(chunks) == 1:
+        return _post_chunk(session, chunks[0])
+    with ThreadPoolExecutor(max_workers=UPSERT_WORKERS) as pool:
+        results = list(pool.map(lambda chunk: _post_chunk(session, chunk), chunks))
+    return all(results)
 
 
 def get_existing_product_ids_for_source() -> Set[str]:
     """Return set of product ids currently in DB for this source."""
     session = _session()
-    # PostgREST: select id where source=SOURCE; paginate if needed
+    # One large Range page covers the whole catalog in a single round-trip;
+    # Content-Range ("start-end/total" with count=exact) tells us if more remain.
     ids: Set[str] = set()
     offset = 0
     while True:
         r = session.get(
             PRODUCTS_ENDPOINT,
-            params={"source": f"eq.{SOURCE}", "select": "id", "offset": offset, "limit": 1000},
+            params={"source": f"eq.{SOURCE}", "select": "id"},
+            headers={
+                "Range-Unit": "items",
+                "Range": f"{offset}-{offset + ID_FETCH_PAGE - 1}",
+                "Prefer": "count=exact",
+            },
             timeout=30,
         )
-        if r.status_code != 200:
+        if r.status_code not in (200, 206):
             logger.error("Failed to fetch existing ids: %s %s", r.status_code, r.text[:300])
             return ids
-        data = r.json()
+        data = orjson.loads(r.content)
         if not data:
             break
         for row in data:
             if row.get("id"):
                 ids.add(row["id"])
-        if len(data) < 1000:
-            break
         offset += len(data)
+        total = r.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+        if not total.isdigit() or offset >= int(total):
+            break
     return ids
 
 
@@ -168,8 +255,8 @@ def remove_stale_products(current_scraped_ids: Set[str]) -> int:
     session = _session()
     deleted = 0
     id_list = list(to_remove)
-    for i in range(0, len(id_list), CHUNK_SIZE):
-        batch = id_list[i : i + CHUNK_SIZE]
+    for i in range(0, len(id_list), DELETE_CHUNK_SIZE):
+        batch = id_list[i : i + DELETE_CHUNK_SIZE]
         # PostgREST: DELETE where id in (id1, id2, ...)
         r = session.delete(
             PRODUCTS_ENDPOINT,
@@ -3,37 +3,164 @@ Image and text embeddings using google/siglip-base-patch16-384 (768-dim).
 - image_embedding: from product main image
 - info_embedding: from product text (title, price, description, category, etc.) via SigLIP text encoder
 """
+import asyncio
 import logging
+import os
 from typing import Optional, List
+
+# Avoid the HF fork warning that serializes tokenization under threaded prefetch
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+import aiohttp
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from io import BytesIO
 import torch
 import numpy as np
 from PIL import Image
 from transformers import SiglipModel, SiglipImageProcessor, SiglipTokenizer
 
+import embeddings_cache
 from config import EMBEDDING_MODEL, EMBEDDING_DIM, REQUEST_TIMEOUT
 
 logger = logging.getLogger(__name__)
 
+# Max concurrent image GETs (shared aiohttp session, bounded by semaphore)
+DOWNLOAD_CONCURRENCY = 8
+
+
+async def download_image(
+    session: aiohttp.ClientSession,
+    image_url: str,
+    semaphore: asyncio.Semaphore,
+) -> Optional[Image.Image]:
+    """Download one image (bounded by semaphore) and return it as RGB PIL image."""
+    async with semaphore:
+        try:
+            async with session.get(image_url) as r:
+                r.raise_for_status()
+                data = await r.read()
+            img = Image.open(BytesIO(data))
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            return img
+        except Exception as e:
+            logger.warning("Download image failed %s: %s", image_url[:80], e)
+            return None
+
+
+async def download_images(
+    session: aiohttp.ClientSession, image_urls: List[str]
+) -> List[Optional[Image.Image]]:
+    """Download many images concurrently. Failed downloads come back as None."""
+    semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+    return await asyncio.gather(
+        *(download_image(session, url, semaphore) for url in image_urls)
+    )
+
+
+def record_to_info_text(record: dict) -> str:
+    """Assemble the info text (title, price, description, ...) for one record."""
+    metadata = record.get("metadata")
+    metadata_str = ""
+    if metadata:
+        if isinstance(metadata, str):
+            # Already serialized (prepare_row stores it as a JSON string)
+            metadata_str = metadata[:1000]
+        else:
+            try:
+                metadata_str = orjson.dumps(metadata).decode()[:1000]
+            except Exception:
+                pass
+    description = record.get("description")
+    price = record.get("price")
+    sale = record.get("sale")
+    category = record.get("category")
+    gender = record.get("gender")
+    parts = (
+        record.get("title") or "",
+        record.get("brand") or "",
+        f"Price: {price}" if price else "",
+        f"Sale: {sale}" if sale else "",
+        f"Category: {category}" if category else "",
+        f"Gender: {gender}" if gender else "",
+        description[:2000] if description else "",
+        metadata_str,
+    )
+    return " ".join(p for p in parts if p)
+
 
 class EmbeddingGenerator:
     """SigLIP for image and text embeddings (768-dim)."""
 
     def __init__(self):
         logger.info("Loading SigLIP model: %s", EMBEDDING_MODEL)
-        # Explicit classes avoid AutoProcessor tokenizer-mapping bug (NoneType.replace) in CI
-        self.image_processor = SiglipImageProcessor.from_pretrained(EMBEDDING_MODEL)
+        # Explicit classes avoid AutoProcessor tokenizer-mapping bug (NoneType.replace) in CI.
+        # Prefer the fast (torchvision-backed) image processor: tensor resize/normalize
+        # instead of per-image scalar PIL ops.
+        try:
+            from transformers import SiglipImageProcessorFast
+            self.image_processor = SiglipImageProcessorFast.from_pretrained(EMBEDDING_MODEL)
+            logger.info("Using fast image processor.")
+        except Exception as e:
+            logger.info("Fast image processor unavailable (%s); using slow one.", e)
+            self.image_processor = SiglipImageProcessor.from_pretrained(EMBEDDING_MODEL)
         self.tokenizer = SiglipTokenizer.from_pretrained(EMBEDDING_MODEL)
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.dtype = torch.float16 if self.device == "cuda" else torch.float32
         self.model = SiglipModel.from_pretrained(EMBEDDING_MODEL)
+        self.model = self.model.to(self.device, dtype=self.dtype)
         self.model.eval()
         self._embedding_dim = EMBEDDING_DIM
+        logger.info("SigLIP on %s (%s)", self.device, self.dtype)
+        # Per-item shapes are fixed (384x384 images, seq len 64) but the batch
+        # dimension varies (download failures, final partial batch), so leave
+        # dynamic-shape handling to dynamo rather than recompiling per size.
+        # Compile the towers, not the wrapper: get_image_features/
+        # get_text_features invoke vision_model/text_model via __call__, while
+        # a compiled SiglipModel would only route forward() and never be hit.
+        # Keep the eager towers so _warmup can revert if compilation breaks.
+        self._eager_towers = None
+        if hasattr(torch, "compile"):
+            try:
+                self._eager_towers = (self.model.vision_model, self.model.text_model)
+                self.model.vision_model = torch.compile(self.model.vision_model)
+                self.model.text_model = torch.compile(self.model.text_model)
+            except Exception as e:
+                logger.warning("torch.compile unavailable, running eager: %s", e)
+                self._eager_towers = None
+        # Pooled keep-alive session for the sync download path
+        self._session = requests.Session()
+        self._session.headers.update(
+            {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
+        )
+        self._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=20))
+        self._warmup()
         logger.info("SigLIP loaded.")
 
+    def _warmup(self):
+        """
+        One dummy image+text forward so compilation happens at load, not
+        mid-scrape. A backend compile error would otherwise surface as None
+        embeddings for the whole run, so on failure revert to the eager towers
+        and warm those up instead.
+        """
+        img = Image.new("RGB", (384, 384))
+        if self.image_embedding_from_pil(img) is not None and self.text_embedding("warmup") is not None:
+            return
+        if self._eager_towers is None:
+            logger.warning("Warmup forward failed.")
+            return
+        logger.warning("Warmup failed under torch.compile; reverting to eager towers.")
+        self.model.vision_model, self.model.text_model = self._eager_towers
+        self._eager_towers = None
+        if self.image_embedding_from_pil(img) is None or self.text_embedding("warmup") is None:
+            logger.warning("Warmup forward failed.")
+
     def _download_image(self, image_url: str) -> Optional[Image.Image]:
         try:
-            headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
-            r = requests.get(image_url, headers=headers, timeout=REQUEST_TIMEOUT)
+            r = self._session.get(image_url, timeout=REQUEST_TIMEOUT)
             r.raise_for_status()
             img = Image.open(BytesIO(r.content))
             if img.mode != "RGB":
@@ -43,57 +170,123 @@ class EmbeddingGenerator:
             logger.warning("Download image failed %s: %s", image_url[:80], e)
             return None
 
-    def _ensure_dim(self, vec: np.ndarray) -> Optional[List[float]]:
-        """Normalize and ensure length EMBEDDING_DIM."""
-        vec = np.asarray(vec, dtype=np.float64).flatten()
-        norm = np.linalg.norm(vec)
-        if norm <= 0:
-            return None
-        vec = vec / norm
-        if len(vec) == self._embedding_dim:
-            return vec.tolist()
+    def _to_device(self, inputs: dict) -> dict:
+        """Move processor/tokenizer tensors to the model device (and dtype for floats)."""
+        return {
+            k: v.to(self.device, dtype=self.dtype) if v.is_floating_point() else v.to(self.device)
+            for k, v in inputs.items()
+        }
+
+    def _autocast(self):
+        """bf16 autocast on CUDA (tensor-core matmuls); no-op on CPU."""
+        return torch.autocast(self.device, dtype=torch.bfloat16, enabled=self.device == "cuda")
+
+    def _ensure_dim(self, vec: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Normalize and ensure length EMBEDDING_DIM. Returns a float32 ndarray
+        (orjson serializes it directly; no Python float list is materialized).
+        """
+        vec = np.asarray(vec, dtype=np.float32).flatten()
         if len(vec) > self._embedding_dim:
             vec = vec[: self._embedding_dim]
-            norm = np.linalg.norm(vec)
-            if norm > 0:
-                vec = vec / norm
-            return vec.tolist()
-        # Pad with zeros and renormalize
-        pad = np.zeros(self._embedding_dim - len(vec))
-        vec = np.concatenate([vec, pad])
+        elif len(vec) < self._embedding_dim:
+            # Zero-padding does not change the norm, so one normalization suffices
+            pad = np.zeros(self._embedding_dim - len(vec), dtype=np.float32)
+            vec = np.concatenate([vec, pad])
         norm = np.linalg.norm(vec)
-        if norm > 0:
-            vec = vec / norm
-        return vec.tolist()
+        if norm <= 0:
+            return None
+        return vec / norm
 
-    def image_embedding(self, image_url: str) -> Optional[List[float]]:
-        """Return 768-dim embedding for the image at image_url."""
+    def image_embedding(self, image_url: str) -> Optional[np.ndarray]:
+        """Return 768-dim embedding for the image at image_url (disk-cached by URL)."""
+        cached = embeddings_cache.get(image_url)
+        if cached is not None:
+            return cached
         img = self._download_image(image_url)
         if img is None:
             return None
+        vec = self.image_embedding_from_pil(img)
+        if vec is not None:
+            embeddings_cache.put(image_url, vec)
+        return vec
+
+    def image_embedding_from_pil(self, img: Image.Image) -> Optional[np.ndarray]:
+        """Return 768-dim embedding for an already-downloaded PIL image."""
+        try:
+            inputs = self._to_device(self.image_processor(images=img, return_tensors="pt"))
+        except Exception as e:
+            logger.warning("Image preprocessing failed: %s", e)
+            return None
         try:
-            inputs = self.image_processor(images=img, return_tensors="pt")
-            with torch.no_grad():
+            with torch.inference_mode(), self._autocast():
                 out = self.model.get_image_features(**inputs)
-                vec = out[0].cpu().numpy()
+                vec = out[0].float().cpu().numpy()
             return self._ensure_dim(vec)
-        except Exception as e:
+        except AttributeError as e:
+            # Only API drift (get_image_features missing) warrants the second
+            # forward; transient failures must not pay for a duplicate pass
             logger.warning("Image embedding failed: %s", e)
             try:
-                with torch.no_grad():
+                with torch.inference_mode(), self._autocast():
                     vision_out = self.model.vision_model(**inputs)
-                    if hasattr(vision_out, "pooler_output") and vision_out.pooler_output is not None:
-                        vec = vision_out.pooler_output[0].cpu().numpy()
-                    elif hasattr(vision_out, "last_hidden_state"):
-                        vec = vision_out.last_hidden_state[0].mean(dim=0).cpu().numpy()
-                    else:
+                    if vision_out.pooler_output is None:
                         return None
+                    vec = vision_out.pooler_output[0].float().cpu().numpy()
                 return self._ensure_dim(vec)
             except Exception as e2:
                 logger.warning("Vision fallback failed: %s", e2)
                 return None
+        except Exception as e:
+            logger.warning("Image embedding failed: %s", e)
+            return None
 
-    def text_embedding(self, text: str) -> Optional[List[float]]:
+    def image_embeddings_batch(self, imgs: List[Image.Image]) -> List[Optional[np.ndarray]]:
+        """Return 768-dim embeddings for a batch of PIL images in one forward pass."""
+        if not imgs:
+            return []
+        try:
+            inputs = self._to_device(self.image_processor(images=imgs, return_tensors="pt"))
+            with torch.inference_mode(), self._autocast():
+                out = self.model.get_image_features(**inputs)
+            return [self._ensure_dim(vec) for vec in out.float().cpu().numpy()]
+        except Exception as e:
+            logger.warning("Batch image embedding failed (%s images): %s", len(imgs), e)
+            # Fall back to per-image so one bad input doesn't sink the whole batch
+            return [self.image_embedding_from_pil(img) for img in imgs]
+
+    def text_embeddings_batch(self, texts: List[Optional[str]]) -> List[Optional[np.ndarray]]:
+        """Return 768-dim embeddings for a batch of texts in one forward pass.
+
+        Empty/None texts come back as None at the same index.
+        """
+        if not texts:
+            return []
+        results: List[Optional[np.ndarray]] = [None] * len(texts)
+        indices = [i for i, t in enumerate(texts) if t and t.strip()]
+        if not indices:
+            return results
+        try:
+            inputs = self.tokenizer(
+                [texts[i].strip() for i in indices],
+                padding="max_length",
+                max_length=64,
+                truncation=True,
+                return_tensors="pt",
+            )
+            text_inputs = self._to_device(
+                {k: v for k, v in inputs.items() if k in ("input_ids", "attention_mask")}
+            )
+            with torch.inference_mode(), self._autocast():
+                out = self.model.get_text_features(**text_inputs)
+            for i, vec in zip(indices, out.float().cpu().numpy()):
+                results[i] = self._ensure_dim(vec)
+            return results
+        except Exception as e:
+            logger.warning("Batch text embedding failed (%s texts): %s", len(indices), e)
+            return [self.text_embedding(t) if t else None for t in texts]
+
+    def text_embedding(self, text: str) -> Optional[np.ndarray]:
         """Return 768-dim embedding for text using SigLIP text encoder."""
         if not (text and text.strip()):
             return None
@@ -106,43 +299,26 @@ class EmbeddingGenerator:
                 truncation=True,
                 return_tensors="pt",
             )
-            text_inputs = {k: v for k, v in inputs.items() if k in ("input_ids", "attention_mask")}
-            with torch.no_grad():
+            text_inputs = self._to_device(
+                {k: v for k, v in inputs.items() if k in ("input_ids", "attention_mask")}
+            )
+            with torch.inference_mode(), self._autocast():
                 out = self.model.get_text_features(**text_inputs)
                 if hasattr(out, "pooler_output") and out.pooler_output is not None:
-                    vec = out.pooler_output[0].cpu().numpy()
+                    vec = out.pooler_output[0].float().cpu().numpy()
                 elif hasattr(out, "last_hidden_state"):
-                    vec = out.last_hidden_state[0, 0, :].cpu().numpy()
+                    vec = out.last_hidden_state[0, 0, :].float().cpu().numpy()
                 else:
-                    vec = out[0].cpu().numpy()
+                    vec = out[0].float().cpu().numpy()
             return self._ensure_dim(vec)
         except Exception as e:
             logger.warning("Text embedding failed: %s", e)
             return None
 
-    def info_embedding_from_record(self, record: dict) -> Optional[List[float]]:
+    def info_embedding_from_record(self, record: dict) -> Optional[np.ndarray]:
         """Build one text string from product record and return its embedding."""
-        parts = []
-        if record.get("title"):
-            parts.append(str(record["title"]))
-        if record.get("brand"):
-            parts.append(str(record["brand"]))
-        if record.get("price"):
-            parts.append(f"Price: {record['price']}")
-        if record.get("sale"):
-            parts.append(f"Sale: {record['sale']}")
-        if record.get("category"):
-            parts.append(f"Category: {record['category']}")
-        if record.get("gender"):
-            parts.append(f"Gender: {record['gender']}")
-        if record.get("description"):
-            parts.append(record["description"][:2000])
-        if record.get("metadata"):
-            import json
-            try:
-                m = record["metadata"] if isinstance(record["metadata"], dict) else json.loads(record["metadata"])
-                parts.append(json.dumps(m)[:1000])
-            except Exception:
-                pass
-        text = " ".join(parts)
-        return self.text_embedding(text)
+        return self.text_embedding(record_to_info_text(record))
+
+    def info_embeddings_from_records(self, records: List[dict]) -> List[Optional[np.ndarray]]:
+        """Batched info embeddings: one tokenizer call and one forward for all records."""
+        return self.text_embeddings_batch([record_to_info_text(r) for r in records])
@@ -0,0 +1,72 @@
+"""
+Local sqlite cache of image embeddings, keyed by (model, image URL hash).
+The SigLIP forward is the most expensive step per product; on reruns a cache
+hit replaces it with a lookup. Keying by model name means switching
+EMBEDDING_MODEL invalidates naturally. Vectors are stored as fp16 bytes.
+"""
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import Optional
+
+import numpy as np
+
+from config import EMBEDDING_MODEL, EMBEDDING_CACHE_PATH
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_conn: Optional[sqlite3.Connection] = None
+
+
+def _connection() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        conn = sqlite3.connect(EMBEDDING_CACHE_PATH, check_same_thread=False)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS image_embeddings ("
+            " model TEXT NOT NULL,"
+            " url_hash BLOB NOT NULL,"
+            " vec BLOB NOT NULL,"
+            " PRIMARY KEY (model, url_hash))"
+        )
+        conn.commit()
+        _conn = conn
+    return _conn
+
+
+def _url_hash(image_url: str) -> bytes:
+    return hashlib.blake2b(image_url.encode(), digest_size=16).digest()
+
+
+def get(image_url: str) -> Optional[np.ndarray]:
+    """Return the cached embedding for image_url, or None on miss/error."""
+    try:
+        with _lock:
+            row = _connection().execute(
+                "SELECT vec FROM image_embeddings WHERE model = ? AND url_hash = ?",
+                (EMBEDDING_MODEL, _url_hash(image_url)),
+            ).fetchone()
+    except Exception as e:
+        logger.warning("Embedding cache read failed: %s", e)
+        return None
+    if row is None:
+        return None
+    return np.frombuffer(row[0], dtype=np.float16).astype(np.float32)
+
+
+def put(image_url: str, vec: np.ndarray) -> None:
+    """Store the embedding for image_url as fp16 bytes. Errors only warn."""
+    blob = np.asarray(vec, dtype=np.float16).tobytes()
+    try:
+        with _lock:
+            conn = _connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO image_embeddings (model, url_hash, vec)"
+                " VALUES (?, ?, ?)",
+                (EMBEDDING_MODEL, _url_hash(image_url), blob),
+            )
+            conn.commit()
+    except Exception as e:
+        logger.warning("Embedding cache write failed: %s", e)
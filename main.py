@@ -1,16 +1,35 @@
 """
 More Money More Love scraper: fetch all products, generate embeddings, upsert to Supabase.
 Smart sync: new products added, existing kept as-is, products no longer in catalog removed.
+Fetching and image downloads run on an asyncio event loop (aiohttp) so page N+1
+is fetched while page N's images download; finished row batches stream to an
+uploader thread, so upload of batch N overlaps embedding of batch N+1 and
+memory stays constant regardless of catalog size.
 Run: python main.py [--dry-run] [--limit N]
 """
 import argparse
+import asyncio
 import logging
+import queue
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+
+import numpy as np
+
 from config import SUPABASE_KEY
 
-from scraper import stream_all_products, product_to_record
-from embeddings import EmbeddingGenerator
-from database import prepare_row, upsert_products, remove_stale_products
+import embeddings_cache
+from scraper import client_session, stream_all_products, product_to_record
+from embeddings import EmbeddingGenerator, download_image, DOWNLOAD_CONCURRENCY
+from database import (
+    prepare_row,
+    prepare_row_no_embeddings,
+    upsert_products,
+    remove_stale_products,
+    get_existing_product_ids_for_source,
+)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -19,6 +38,173 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Records waiting for their image download before embedding
+PIPELINE_DEPTH = 64
+
+# Products embedded per model forward pass
+EMBED_BATCH_SIZE = 32
+
+# Rows accumulated before handing a batch to the uploader thread
+UPLOAD_BATCH_ROWS = 256
+
+# Row batches allowed in flight between pipeline and uploader
+UPLOAD_QUEUE_DEPTH = 4
+
+
+def _uploader(upload_q: queue.Queue, result: dict):
+    """
+    Consume row batches from the pipeline and upsert them until sentinel.
+    Must keep draining on errors: if this thread dies, the pipeline blocks
+    forever on the bounded queue.
+    """
+    while True:
+        batch = upload_q.get()
+        if batch is None:
+            return
+        try:
+            if not upsert_products(batch):
+                result["ok"] = False
+        except Exception as e:
+            logger.error("Uploader batch failed (%s rows): %s", len(batch), e)
+            result["ok"] = False
+
+
+async def _run_pipeline(
+    gen: EmbeddingGenerator,
+    limit: int | None,
+    existing_ids: set[str],
+    upload_q: queue.Queue | None,
+) -> tuple[int, int, int, set[str]]:
+    """
+    Stream products, download images concurrently, embed in batches, and flush
+    finished rows to the uploader (no-op when upload_q is None, i.e. dry run).
+    Returns (new_count, update_count, total, current_ids). New and update rows
+    flush in separate batches: update rows carry no embedding columns.
+    """
+    new_count = 0
+    update_count = 0
+    total = 0
+    current_ids: set[str] = set()
+    new_pending: list = []
+    update_pending: list = []
+    semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+    work_q: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+    loop = asyncio.get_running_loop()
+    # Model inference runs off-loop so downloads keep flowing while it computes
+    embed_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed")
+
+    async def ship(pending: list):
+        """Hand accumulated rows to the uploader (blocking put off-loop)."""
+        if upload_q is not None and pending:
+            await loop.run_in_executor(None, upload_q.put, list(pending))
+        pending.clear()
+
+    async with client_session() as session:
+
+        async def produce():
+            nonlocal total, update_count
+            try:
+                # aclosing runs the generator's cleanup (cancelling its page
+                # prefetch) before the session context exits, even on early break
+                async with aclosing(stream_all_products(session)) as products:
+                    async for raw in products:
+                        if limit is not None and total >= limit:
+                            logger.info("Reached limit %s", limit)
+                            break
+                        total += 1
+                        record = product_to_record(raw)
+                        title = record.get("title") or record["product_url"]
+                        if not record.get("image_url"):
+                            logger.warning("Skip (no image): %s", title[:60])
+                            continue
+                        if record["id"] in existing_ids:
+                            # Already embedded: refresh mutable fields only, no model work
+                            current_ids.add(record["id"])
+                            update_count += 1
+                            update_pending.append(prepare_row_no_embeddings(record))
+                            if len(update_pending) >= UPLOAD_BATCH_ROWS:
+                                await ship(update_pending)
+                            continue
+                        cached = embeddings_cache.get(record["image_url"])
+                        if cached is not None:
+                            # Cached vector: no download, no vision forward
+                            await work_q.put((record, cached))
+                            continue
+                        # Kick off the download now; embedding consumes it in order
+                        task = asyncio.ensure_future(
+                            download_image(session, record["image_url"], semaphore)
+                        )
+                        await work_q.put((record, task))
+            finally:
+                # Consumer must always see the sentinel, or a producer error
+                # leaves it blocked on work_q.get() and the run hangs
+                await work_q.put(None)
+
+        producer = asyncio.ensure_future(produce())
+
+        async def flush(batch):
+            """Embed one batch (single forward per modality) and queue its rows."""
+            nonlocal new_count
+            records = [record for record, _ in batch]
+            for record in records:
+                record["brand"] = "Moremoney Morelove"
+
+            # Payload per item is either a cached vector or a pending download
+            image_embs: list = [None] * len(batch)
+            present = []
+            for i, (_, payload) in enumerate(batch):
+                if isinstance(payload, np.ndarray):
+                    image_embs[i] = payload
+                    continue
+                img = await payload
+                if img is not None:
+                    present.append((i, img))
+            if present:
+                embs = await loop.run_in_executor(
+                    embed_pool, gen.image_embeddings_batch, [img for _, img in present]
+                )
+                for (i, _), emb in zip(present, embs):
+                    image_embs[i] = emb
+                    if emb is not None:
+                        embeddings_cache.put(records[i]["image_url"], emb)
+            info_embs = await loop.run_in_executor(
+                embed_pool, gen.info_embeddings_from_records, records
+            )
+
+            for record, image_emb, info_emb in zip(records, image_embs, info_embs):
+                title = record.get("title") or record["product_url"]
+                if image_emb is None:
+                    logger.warning("No image embedding for %s", title[:60])
+                if info_emb is None:
+                    logger.warning("No info embedding for %s", title[:60])
+                current_ids.add(record["id"])
+                new_count += 1
+                new_pending.append(
+                    prepare_row(record, image_embedding=image_emb, info_embedding=info_emb)
+                )
+            if len(new_pending) >= UPLOAD_BATCH_ROWS:
+                await ship(new_pending)
+            logger.info("Embedded batch of %s (new rows so far: %s)", len(batch), new_count)
+
+        batch: list = []
+        while True:
+            item = await work_q.get()
+            if item is None:
+                break
+            batch.append(item)
+            if len(batch) >= EMBED_BATCH_SIZE:
+                await flush(batch)
+                batch = []
+        if batch:
+            await flush(batch)
+
+        await producer
+        await ship(new_pending)
+        await ship(update_pending)
+
+    embed_pool.shutdown(wait=True)
+    return new_count, update_count, total, current_ids
+
 
 def run(dry_run: bool = False, limit: int | None = None):
     if not SUPABASE_KEY and not dry_run:
@@ -28,58 +214,51 @@ def run(dry_run: bool = False, limit: int | None = None):
     logger.info("Starting scraper (dry_run=%s, limit=%s)", dry_run, limit)
     gen = EmbeddingGenerator()
 
-    # 1) Collect all products and build rows (so we can batch upsert and know current set for sync)
-    rows: list = []
-    total = 0
-    for raw in stream_all_products():
-        if limit is not None and total >= limit:
-            logger.info("Reached limit %s", limit)
-            break
-        total += 1
-        record = product_to_record(raw)
-        product_url = record["product_url"]
-        title = record.get("title") or product_url
-
-        if not record.get("image_url"):
-            logger.warning("Skip (no image): %s", title[:60])
-            continue
-
-        logger.info("Processing %s", title[:60])
-        image_emb = gen.image_embedding(record["image_url"])
-        if image_emb is None:
-            logger.warning("No image embedding for %s", title[:60])
-        record["brand"] = "Moremoney Morelove"
-        info_emb = gen.info_embedding_from_record(record)
-        if info_emb is None:
-            logger.warning("No info embedding for %s", title[:60])
-
-        row = prepare_row(record, image_embedding=image_emb, info_embedding=info_emb)
-        rows.append(row)
+    # Products already in DB keep their embeddings; only new ones hit the model
+    existing_ids: set[str] = set()
+    if SUPABASE_KEY:
+        existing_ids = get_existing_product_ids_for_source()
+        logger.info("Found %s existing products (embeddings will be reused).", len(existing_ids))
 
-    if dry_run:
-        logger.info("Dry run: would upsert %s products (no DB write, no stale removal)", len(rows))
-        return
+    # Uploader thread drains row batches while the pipeline keeps embedding
+    upload_q: queue.Queue | None = None
+    upload_result = {"ok": True}
+    uploader = None
+    if not dry_run:
+        upload_q = queue.Queue(maxsize=UPLOAD_QUEUE_DEPTH)
+        uploader = threading.Thread(
+            target=_uploader, args=(upload_q, upload_result), name="uploader", daemon=True
+        )
+        uploader.start()
 
-    if not rows:
-        logger.info("No products to upsert.")
-        removed = remove_stale_products(set())
-        if removed:
-            logger.info("Removed %s stale product(s) no longer in catalog.", removed)
+    new_count, update_count, total, current_ids = asyncio.run(
+        _run_pipeline(gen, limit, existing_ids, upload_q)
+    )
+
+    if uploader is not None:
+        upload_q.put(None)
+        uploader.join()
+
+    if dry_run:
+        logger.info(
+            "Dry run: would upsert %s new and %s existing products (no DB write, no stale removal)",
+            new_count, update_count,
+        )
         return
 
-    # 2) Batch upsert (PostgREST HTTP, reliable for scheduled runs)
-    if not upsert_products(rows):
+    if not upload_result["ok"]:
         logger.error("Upsert failed; skipping stale-removal to avoid data loss.")
         sys.exit(1)
-    logger.info("Upserted %s products.", len(rows))
+    logger.info("Upserted %s products (%s new, %s existing).",
+                new_count + update_count, new_count, update_count)
 
-    # 3) Smart sync: remove products for this source that are no longer in the catalog
-    current_ids = {r["id"] for r in rows}
+    # Smart sync: remove products for this source that are no longer in the catalog
     removed = remove_stale_products(current_ids)
     if removed:
         logger.info("Removed %s stale product(s) no longer in catalog.", removed)
 
-    logger.info("Done. Processed=%s, upserted=%s, stale_removed=%s", total, len(rows), removed)
+    logger.info("Done. Processed=%s, upserted=%s, stale_removed=%s",
+                total, new_count + update_count, removed)
 
 
 if __name__ == "__main__":
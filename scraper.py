@@ -1,13 +1,16 @@
 """
 Fetch all products from More Money More Love (Shopify) via collection JSON API.
 Pagination: page=1, 2, ... until products array is empty.
+Fetching is async (aiohttp): page N+1 is prefetched while page N is processed.
 """
 import re
-import time
+import asyncio
 import logging
-from typing import Iterator, List, Dict, Any, Optional
-import requests
-from bs4 import BeautifulSoup
+from html import unescape
+from typing import AsyncIterator, List, Dict, Any, Optional
+
+import aiohttp
+import orjson
 
 from config import (
     COLLECTION_URL,
@@ -17,7 +20,9 @@ from config import (
     REQUEST_TIMEOUT,
     REQUEST_DELAY,
     MAX_RETRIES,
+    SOURCE,
 )
+from database import generate_id
 
 logger = logging.getLogger(__name__)
 
@@ -25,68 +30,87 @@ logger = logging.getLogger(__name__)
 COLLECTION_HANDLE = "shop-all"
 JSON_BASE = "https://moremoneymorelove.de/en/collections"
 
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+
+# Connection pool shared by page fetches and image downloads
+CONNECTOR_LIMIT = 20
+
+
+def client_session() -> aiohttp.ClientSession:
+    """Shared aiohttp session: pooled connections, cached DNS, default headers."""
+    connector = aiohttp.TCPConnector(limit=CONNECTOR_LIMIT, ttl_dns_cache=300)
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers={"User-Agent": USER_AGENT},
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+    )
+
+
+# Shopify body_html is short marketing copy; regex stripping beats building a DOM
+_TAG_RE = re.compile(r"<[^>]+>")
+_WS_RE = re.compile(r"\s+")
+
 
 def _strip_html(html: str) -> str:
     if not html:
         return ""
-    soup = BeautifulSoup(html, "html.parser")
-    return soup.get_text(separator=" ", strip=True)
+    return _WS_RE.sub(" ", unescape(_TAG_RE.sub(" ", html))).strip()
+
+
+# e.g. "Sweaters & Hoodies" -> "Sweaters, Hoodies"
+_CAT_RE = re.compile(r"\s+(?:&|and)\s+")
 
 
 def _normalize_category(product_type: Optional[str]) -> Optional[str]:
     """Map product_type to category; if multiple (e.g. 'Sweaters & Hoodies'), comma-separate."""
     if not product_type:
         return None
-    # e.g. "Sweaters & Hoodies" -> "Sweaters, Hoodies"
-    out = product_type.replace(" & ", ", ").replace(" and ", ", ")
-    return out.strip() if out else None
+    out = _CAT_RE.sub(", ", product_type).strip()
+    return out or None
 
 
 def _infer_gender(product: Dict[str, Any]) -> str:
     """Infer gender: 'woman' only for girls/women products, else 'man' (store is mostly men)."""
-    tags = [t.upper() for t in (product.get("tags") or [])]
     ptype = (product.get("product_type") or "").upper()
     title = (product.get("title") or "").upper()
-    if "GIRLS" in ptype or "GIRLS" in title or any("GIRL" in t for t in tags):
+    if "GIRLS" in ptype or "GIRLS" in title:
+        return "woman"
+    if any("GIRL" in t.upper() for t in (product.get("tags") or [])):
         return "woman"
     if "WOMEN" in ptype or "WOMEN" in title:
         return "woman"
     return "man"
 
 
-def _price_string(product: Dict[str, Any]) -> Optional[str]:
-    """Original price only, with currency. e.g. 159.99EUR. Uses compare_at_price when present."""
+def _extract_prices(product: Dict[str, Any]) -> tuple:
+    """
+    Return (price, sale) with currency, e.g. ("159.99EUR", "54.99EUR").
+    price is the original (compare_at_price when present); sale is set only when
+    the current price undercuts it. One variants read, one float cast per value.
+    """
     variants = product.get("variants") or []
     if not variants:
-        return None
-    v = variants[0]
-    compare = v.get("compare_at_price")  # original
-    price = v.get("price")  # fallback if no compare
-    value = compare or price
-    if not value:
-        return None
-    try:
-        return f"{float(value):.2f}EUR"
-    except (TypeError, ValueError):
-        return f"{value}EUR"
-
-
-def _sale_value(product: Dict[str, Any]) -> Optional[str]:
-    """Sale price with currency when product is on sale. e.g. 54.99EUR."""
-    variants = product.get("variants") or []
-    if not variants:
-        return None
+        return None, None
     v = variants[0]
     price = v.get("price")
-    compare = v.get("compare_at_price")
-    if not price:
-        return None
+    compare = v.get("compare_at_price")  # original
+    original = compare or price
+    if not original:
+        return None, None
     try:
-        if compare and float(price) < float(compare):
-            return f"{float(price):.2f}EUR"
-        return None
+        original_str = f"{float(original):.2f}EUR"
     except (TypeError, ValueError):
-        return f"{price}EUR"
+        # Unparseable values pass through raw, as before
+        return f"{original}EUR", f"{price}EUR" if price and compare else None
+    sale = None
+    if price and compare:
+        try:
+            price_f = float(price)
+            if price_f < float(compare):
+                sale = f"{price_f:.2f}EUR"
+        except (TypeError, ValueError):
+            sale = f"{price}EUR"
+    return original_str, sale
 
 
 def _product_url(handle: str) -> str:
@@ -95,15 +119,13 @@ def _product_url(handle: str) -> str:
 
 def _image_urls(product: Dict[str, Any]) -> tuple:
     """Return (first_image_url, additional_images_str). additional_images: 'url1 , url2'."""
-    images = product.get("images") or []
-    urls = [img.get("src") for img in images if img.get("src")]
-    urls = [u for u in urls if u]
+    urls = [src for img in (product.get("images") or []) if (src := img.get("src"))]
     if not urls:
         return "", ""
-    main = urls[0]
-    rest = urls[1:]
-    additional = " , ".join(rest) if rest else ""
-    return main, additional
+    return urls[0], " , ".join(urls[1:])
+
+
+_SIZE_NAMES = frozenset(("size", "größe", "grösse"))
 
 
 def _sizes(product: Dict[str, Any]) -> Optional[str]:
@@ -111,47 +133,59 @@ def _sizes(product: Dict[str, Any]) -> Optional[str]:
     options = product.get("options") or []
     for opt in options:
         name = (opt.get("name") or "").lower()
-        if name in ("size", "größe", "grösse"):
+        if name in _SIZE_NAMES:
             vals = opt.get("values") or []
             return ", ".join(str(v) for v in vals)
     return None
 
 
-def fetch_collection_page(page: int) -> List[Dict[str, Any]]:
+async def fetch_collection_page(session: aiohttp.ClientSession, page: int) -> List[Dict[str, Any]]:
     """Fetch one page of products from collection JSON. Returns list of product dicts."""
     url = f"{JSON_BASE}/{COLLECTION_HANDLE}{PRODUCTS_JSON_PATH}"
     params = {"page": page, "limit": LIMIT_PER_PAGE}
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-        "Accept": "application/json",
-    }
+    headers = {"Accept": "application/json"}
     for attempt in range(MAX_RETRIES):
         try:
-            r = requests.get(url, params=params, headers=headers, timeout=REQUEST_TIMEOUT)
-            r.raise_for_status()
-            data = r.json()
-            products = data.get("products") or []
-            return products
+            async with session.get(url, params=params, headers=headers) as r:
+                r.raise_for_status()
+                data = orjson.loads(await r.read())
+            return data.get("products") or []
         except Exception as e:
             logger.warning(f"Page {page} attempt {attempt + 1}/{MAX_RETRIES}: {e}")
             if attempt < MAX_RETRIES - 1:
-                time.sleep(REQUEST_DELAY * (attempt + 1))
+                await asyncio.sleep(REQUEST_DELAY * (attempt + 1))
     return []
 
 
-def stream_all_products() -> Iterator[Dict[str, Any]]:
-    """Yield product dicts from all collection pages until a page returns no products."""
+async def _fetch_page_after_delay(session: aiohttp.ClientSession, page: int) -> List[Dict[str, Any]]:
+    """Politeness delay, then fetch. Used for prefetching so the delay overlaps work."""
+    await asyncio.sleep(REQUEST_DELAY)
+    return await fetch_collection_page(session, page)
+
+
+async def stream_all_products(session: aiohttp.ClientSession) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Yield product dicts from all collection pages until a page returns no products.
+    Page N+1 is fetched in the background while page N's products are consumed.
+    """
     page = 1
-    while True:
-        products = fetch_collection_page(page)
-        if not products:
-            logger.info(f"Page {page} returned 0 products, stopping.")
-            break
-        logger.info(f"Page {page}: got {len(products)} products")
-        for p in products:
-            yield p
-        page += 1
-        time.sleep(REQUEST_DELAY)
+    next_task = asyncio.ensure_future(fetch_collection_page(session, page))
+    try:
+        while True:
+            products = await next_task
+            if not products:
+                logger.info(f"Page {page} returned 0 products, stopping.")
+                break
+            next_task = asyncio.ensure_future(_fetch_page_after_delay(session, page + 1))
+            logger.info(f"Page {page}: got {len(products)} products")
+            for p in products:
+                yield p
+            page += 1
+    finally:
+        # Consumer may stop mid-page (e.g. --limit); don't leave the prefetch
+        # pending when the session closes under it
+        if not next_task.done():
+            next_task.cancel()
 
 
 def product_to_record(product: Dict[str, Any]) -> Dict[str, Any]:
@@ -162,8 +196,7 @@ def product_to_record(product: Dict[str, Any]) -> Dict[str, Any]:
     description = _strip_html(product.get("body_html") or "")
     category = _normalize_category(product.get("product_type"))
     gender = _infer_gender(product)
-    price = _price_string(product)
-    sale = _sale_value(product)
+    price, sale = _extract_prices(product)
     size = _sizes(product)
     tags = product.get("tags") or []
 
@@ -176,6 +209,8 @@ def product_to_record(product: Dict[str, Any]) -> Dict[str, Any]:
     }
 
     return {
+        # id computed once here; prepare_row and the sync set reuse it
+        "id": generate_id(SOURCE, product_url),
         "product_url": product_url,
         "image_url": image_url,
         "additional_images": additional_images,